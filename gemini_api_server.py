@@ -1,22 +1,40 @@
 import os
-import json
+import re
+import asyncio
+import hashlib
+import hmac
 import logging
+import sqlite3
+import time
 import base64
 from io import BytesIO
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from contextlib import asynccontextmanager, closing
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import BackgroundTasks, FastAPI, File, Form, HTTPException, Request, UploadFile
+from pydantic import BaseModel, RootModel, TypeAdapter, ValidationError, field_validator
+from typing_extensions import TypedDict
 import google.generativeai as genai
+from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.api_core import exceptions as google_exceptions
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential_jitter
 from dotenv import load_dotenv
 from PIL import Image
+import numpy as np
+# libvips уменьшает JPEG потоково, не разворачивая полный растр; если его нет, работаем через PIL
+try:
+    import pyvips
+    # libvips пишет десятки INFO-строк на каждое изображение
+    logging.getLogger("pyvips").setLevel(logging.WARNING)
+except (ImportError, OSError):
+    pyvips = None
 import httpx
+import orjson
 
 # --- Настройка ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 load_dotenv()
 
-app = FastAPI(title="Универсальный API Шлюз для Gemini и Telegram")
-
 # --- Конфигурация из .env ---
 try:
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -29,17 +47,49 @@ try:
     genai.configure(api_key=GEMINI_API_KEY)
     logger.info("API Gemini и токен бота успешно настроены на сервере.")
 except Exception as e:
-    logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА при настройке: {e}")
+    logger.critical("КРИТИЧЕСКАЯ ОШИБКА при настройке: %s", e)
     # Приложение не сможет работать без этих ключей, можно было бы и завершить, но FastAPI продолжит.
 
+# --- Модели Gemini (создаются один раз при старте процесса) ---
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+MODEL_FLASH_LITE = genai.GenerativeModel('gemini-2.5-flash-lite')
+MODEL_FLASH_LITE_SAFE = genai.GenerativeModel('gemini-2.5-flash-lite', safety_settings=SAFETY_SETTINGS)
+# text-embedding-004 выведена из эксплуатации; у gemini-embedding-001 вектор усекается до 768 измерений (MRL)
+EMBEDDING_MODEL = 'models/gemini-embedding-001'
+EMBEDDING_DIMENSIONS = 768
+
+# Сколько наборов документов из одного пакетного запроса распознаются одновременно
+BATCH_CONCURRENCY = int(os.getenv("GEMINI_BATCH_CONCURRENCY", "4"))
+
+# Сколько запросов к Gemini процесс держит в полете одновременно, чтобы всплеск не выбирал всю квоту.
+# Лимит действует на каждый воркер uvicorn отдельно: общий предел = GEMINI_CONCURRENCY * UVICORN_WORKERS.
+GEMINI_SEMAPHORE = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "16")))
+
 # --- Модели данных для FastAPI ---
 class RecognizeDocsRequest(BaseModel):
     images_base64: list[str]
     country: str
 
+class RecognizeDocsBatchRequest(BaseModel):
+    items: list[RecognizeDocsRequest]
+
 class NotifyRequest(BaseModel):
     user_id: int
     text: str
+
+    # Пустые сообщения и сообщения из одних пробелов Telegram не примет: отклоняем сразу (422), без запроса к API.
+    # Длину не проверяем: лимит 4096 считается по тексту после разбора Markdown, его проверит сам Telegram
+    @field_validator("text")
+    @classmethod
+    def text_not_blank(cls, text: str) -> str:
+        if not text.strip():
+            raise ValueError("текст уведомления пуст")
+        return text
     
 class ParseDealRequest(BaseModel):
     description: str
@@ -47,152 +97,620 @@ class ParseDealRequest(BaseModel):
 class BuyoutPlanRequest(BaseModel):
     deal_description: str
 
+# ==============================================================================
+# ПРОМПТЫ (собираются один раз при импорте)
+# ==============================================================================
+
+# Входит в ключ кэша ответов: при любом изменении промптов или схем нужно увеличить версию
+PROMPT_VERSION = "v3"
+
+# ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ПАСПОРТА РФ
+DOC_PROMPT_RF = """
+Проанализируй эти три изображения: основной разворот паспорта РФ, страница с пропиской и селфи с паспортом.
+Извлеки все данные и верни их в виде ОДНОГО плоского JSON объекта.
+Ключи: "Фамилия", "Имя", "Отчество", "Дата рождения", "Серия и номер паспорта", "Кем выдан", "Дата выдачи", "Адрес регистрации".
+Если поле не найдено, значение должно быть пустой строкой.
+"""
+
+# ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ИНОСТРАННЫХ ДОКУМЕНТОВ
+DOC_PROMPT_FOREIGN = """
+Проанализируй эти четыре изображения: паспорт иностранного гражданина, регистрация в РФ, патент и селфи с паспортом.
+Извлеки все данные и верни их в виде ОДНОГО плоского JSON объекта.
+Ключи: "ФИО", "Гражданство", "Дата рождения", "Номер паспорта", "Адрес регистрации в РФ", "Номер патента".
+Если поле не найдено, значение должно быть пустой строкой.
+"""
+
+PARSE_DEAL_PROMPT_HEAD = """
+Проанализируй описание комплекта: \""""
+PARSE_DEAL_PROMPT_TAIL = """\".
+Извлеки название/модель велосипеда, его серийный номер (VIN),
+а также количество, емкость (Ah) и серийные номера аккумуляторов.
+Ключи: "model_name", "bike_number", "batteries".
+"batteries" должен быть списком словарей, каждый с ключами "capacity" и "number".
+Если что-то не найдено, значение должно быть null.
+"""
+
+# ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ПЛАНОВ
+BUYOUT_PROMPT_HEAD = """
+Проанализируй описание комплекта для курьера: \""""
+BUYOUT_PROMPT_TAIL = """\".
+Это может быть электровелосипед, аккумуляторы или и то, и другое.
+Примерная рыночная стоимость такого комплекта около 80,000 - 120,000 рублей.
+Твоя задача - сгенерировать 3-4 варианта плана рассрочки (выкупа) для этого комплекта.
+Ключами в JSON должны быть короткие идентификаторы (например, "plan_1", "plan_2"),
+а значениями - словари с ключами:
+- "label": Короткое и понятное описание для кнопки (например, "3 мес / 16000 ₽").
+- "full_label": Полное описание для подтверждения (например, "3 месяца: 7 платежей по 16 000 ₽").
+- "first_payment": Сумма первого взноса (число).
+- "total_payments": Общее количество платежей (число).
+- "period_days": Периодичность платежей в днях (30 для месяца, 14 для 2 недель).
+Пример твоего идеального ответа:
+{
+    "plan_1": {"label": "3 мес / 16000 ₽", "full_label": "3 месяца: 7 платежей по 16 000 ₽ (раз в 2 недели)", "first_payment": 16000, "total_payments": 7, "period_days": 14},
+    "plan_2": {"label": "4 мес / 21000 ₽", "full_label": "4 месяца: 5 платежей по 21 000 ₽ (раз в месяц)", "first_payment": 21000, "total_payments": 5, "period_days": 30}
+}
+"""
+
+# ==============================================================================
+# СХЕМЫ ОТВЕТОВ (Gemini в режиме JSON возвращает только валидный JSON по схеме)
+# ==============================================================================
+
+def _string_fields(*names: str) -> dict:
+    return {name: {"type": "STRING"} for name in names}
+
+def _json_config(schema: dict) -> dict:
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+_DOC_RF_FIELDS = ("Фамилия", "Имя", "Отчество", "Дата рождения", "Серия и номер паспорта", "Кем выдан", "Дата выдачи", "Адрес регистрации")
+DOC_RF_SCHEMA = {"type": "OBJECT", "properties": _string_fields(*_DOC_RF_FIELDS), "required": list(_DOC_RF_FIELDS)}
+
+_DOC_FOREIGN_FIELDS = ("ФИО", "Гражданство", "Дата рождения", "Номер паспорта", "Адрес регистрации в РФ", "Номер патента")
+DOC_FOREIGN_SCHEMA = {"type": "OBJECT", "properties": _string_fields(*_DOC_FOREIGN_FIELDS), "required": list(_DOC_FOREIGN_FIELDS)}
+
+PARSE_DEAL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "model_name": {"type": "STRING", "nullable": True},
+        "bike_number": {"type": "STRING", "nullable": True},
+        "batteries": {
+            "type": "ARRAY",
+            "nullable": True,
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    # Емкость в Ah числом: "20Ah" -> 20
+                    "capacity": {"type": "NUMBER", "nullable": True},
+                    "number": {"type": "STRING", "nullable": True},
+                },
+            },
+        },
+    },
+    "required": ["model_name", "bike_number", "batteries"],
+}
+
+_BUYOUT_PLAN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "label": {"type": "STRING"},
+        "full_label": {"type": "STRING"},
+        "first_payment": {"type": "INTEGER"},
+        "total_payments": {"type": "INTEGER"},
+        "period_days": {"type": "INTEGER"},
+    },
+    "required": ["label", "full_label", "first_payment", "total_payments", "period_days"],
+}
+# Схема Gemini не поддерживает произвольные ключи, поэтому перечисляем plan_1..plan_4 (промпт просит 3-4 плана)
+BUYOUT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {f"plan_{i}": _BUYOUT_PLAN_SCHEMA for i in range(1, 5)},
+    "required": ["plan_1", "plan_2", "plan_3"],
+}
+
+DOC_RF_CONFIG = _json_config(DOC_RF_SCHEMA)
+DOC_FOREIGN_CONFIG = _json_config(DOC_FOREIGN_SCHEMA)
+PARSE_DEAL_CONFIG = _json_config(PARSE_DEAL_SCHEMA)
+BUYOUT_CONFIG = _json_config(BUYOUT_SCHEMA)
+
+# Проверка ответов выполняется в pydantic-core: отсутствующие ключи и нечисловые суммы отсекаются сразу
+class Battery(BaseModel):
+    # int | float: целая емкость уходит клиенту как 20, а не 20.0
+    capacity: int | float | None = None
+    number: str | None = None
+
+class CustomDeal(BaseModel):
+    model_name: str | None = None
+    bike_number: str | None = None
+    batteries: list[Battery] | None = None
+
+class BuyoutPlan(BaseModel):
+    label: str
+    full_label: str
+    first_payment: int
+    total_payments: int
+    period_days: int
+
+class BuyoutResponse(RootModel[dict[str, BuyoutPlan]]):
+    pass
+
+DOC_RF_ADAPTER = TypeAdapter(TypedDict("DocumentsRF", {name: str for name in _DOC_RF_FIELDS}))
+DOC_FOREIGN_ADAPTER = TypeAdapter(TypedDict("DocumentsForeign", {name: str for name in _DOC_FOREIGN_FIELDS}))
+
+# Промпт, конфиг генерации и проверка ответа по стране документов; все, кроме РФ, — иностранные
+DOC_SPECS = {'РФ': (DOC_PROMPT_RF, DOC_RF_CONFIG, DOC_RF_ADAPTER)}
+DOC_SPEC_FOREIGN = (DOC_PROMPT_FOREIGN, DOC_FOREIGN_CONFIG, DOC_FOREIGN_ADAPTER)
+
+# ==============================================================================
+# КЭШ ОТВЕТОВ
+# ==============================================================================
+
+class ResponseCache:
+    """Кэш ответов Gemini в SQLite: переживает перезапуск и общий для всех воркеров uvicorn."""
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+                conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning("Кэш ответов Gemini недоступен (%s): %s", path, e)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _get_sync(self, key: str) -> dict | None:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM responses WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def _set_sync(self, key: str, value: dict) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, orjson.dumps(value), time.time() + self.ttl))
+
+    # Ошибка кэша не должна ронять запрос: в худшем случае просто идем в Gemini
+    async def get(self, key: str) -> dict | None:
+        try:
+            return await asyncio.to_thread(self._get_sync, key)
+        except sqlite3.Error as e:
+            logger.warning("Ошибка чтения кэша ответов: %s", e)
+            return None
+
+    async def set(self, key: str, value: dict) -> None:
+        try:
+            await asyncio.to_thread(self._set_sync, key, value)
+        except sqlite3.Error as e:
+            logger.warning("Ошибка записи в кэш ответов: %s", e)
+
+# Описания комплектов в парке повторяются (одни и те же модели и наборы АКБ)
+response_cache = ResponseCache(os.getenv("GEMINI_CACHE_DB", "gemini_cache.sqlite3"), ttl=7 * 24 * 60 * 60)
+
+_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+def _numbers_in(text: str) -> tuple[str, ...]:
+    """Числа из описания (количество, емкость, цены) без учета порядка."""
+    return tuple(sorted(n.replace(',', '.') for n in _NUMBER_RE.findall(text)))
+
+class SemanticCache:
+    """Кэш по смыслу: ответ на описание, эмбеддинг которого близок к уже встречавшемуся.
+
+    Близости эмбеддингов мало: "2 АКБ 20Ah" и "3 АКБ 30Ah" почти неотличимы для модели,
+    а планы для них разные. Поэтому ответ переиспользуется, только если числа в описаниях совпадают.
+    """
+
+    def __init__(self, threshold: float, maxsize: int):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._vectors: list[np.ndarray] = []
+        self._numbers: list[tuple[str, ...]] = []
+        self._values: list[dict] = []
+        self._matrix: np.ndarray | None = None
+
+    def get(self, vector: np.ndarray, text: str) -> dict | None:
+        if not self._values:
+            return None
+        if self._matrix is None:
+            self._matrix = np.vstack(self._vectors)
+        # Векторы нормированы, поэтому скалярное произведение и есть косинусная близость
+        similarities = self._matrix @ vector
+        numbers = _numbers_in(text)
+        similarities[[n != numbers for n in self._numbers]] = -1.0
+        best = int(np.argmax(similarities))
+        return self._values[best] if similarities[best] >= self.threshold else None
+
+    def set(self, vector: np.ndarray, text: str, value: dict) -> None:
+        self._vectors.append(vector)
+        self._numbers.append(_numbers_in(text))
+        self._values.append(value)
+        if len(self._values) > self.maxsize:
+            del self._vectors[0], self._numbers[0], self._values[0]
+        self._matrix = None
+
+# Описания планов выкупа часто отличаются только формулировкой ("велосипед и 2 АКБ 20Ah" / "электровелик, 2 батареи по 20Ah").
+# Кэш живет только в памяти процесса и в постоянный кэш ответов не попадает: совпадение приблизительное.
+# Порог не откалиброван на gemini-embedding-001, поэтому взят с запасом; главная защита — совпадение чисел.
+buyout_semantic_cache = SemanticCache(threshold=float(os.getenv("GEMINI_SEMANTIC_THRESHOLD", "0.95")), maxsize=2048)
+
+# Запросы к Gemini, которые выполняются прямо сейчас, по ключу кэша
+_inflight: dict[str, asyncio.Future] = {}
+
+async def _single_flight(inflight: dict[str, asyncio.Future], key: str, call) -> dict | None:
+    """Склеивает одновременные одинаковые запросы: Gemini вызывается один раз, остальные ждут его ответа."""
+    future = inflight.get(key)
+    if future is not None:
+        try:
+            # shield: отмена одного из ожидающих не должна отменять общий результат
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise  # отменили самого ожидающего
+            # Ведущий запрос оборвался, не дав ответа: делаем вызов сами
+            return await _single_flight(inflight, key, call)
+    future = asyncio.get_running_loop().create_future()
+    inflight[key] = future
+    try:
+        data = await call()
+    except BaseException:
+        future.cancel()
+        raise
+    else:
+        future.set_result(data)
+        return data
+    finally:
+        del inflight[key]
+
+def _cache_key(kind: str, text: str) -> str:
+    # Регистр не приводится: серийные номера и модели могут различаться только им
+    return hashlib.sha256(f"{PROMPT_VERSION}:{kind}:{text.strip()}".encode()).hexdigest()
+
+async def _cached_call(kind: str, text: str, call, approximate=None) -> dict | None:
+    """Возвращает ответ из кэша по тексту запроса, иначе вызывает Gemini (один раз на одинаковые запросы).
+
+    approximate — необязательный поиск похожего ответа после промаха точного кэша;
+    найденное им в постоянный кэш не записывается.
+    """
+    key = _cache_key(kind, text)
+    cached = await response_cache.get(key)
+    if cached is not None:
+        logger.info("Ответ (%s) взят из кэша.", kind)
+        return cached
+    if approximate is not None:
+        similar = await approximate()
+        if similar is not None:
+            return similar
+    data = await _single_flight(_inflight, key, call)
+    if data is not None:
+        await response_cache.set(key, data)
+    return data
+
 # ==============================================================================
 # ВСЯ ЛОГИКА GEMINI С ТВОИМИ ОРИГИНАЛЬНЫМИ, ПРАВИЛЬНЫМИ ПРОМПТАМИ
 # ==============================================================================
 
-def recognize_documents_with_gemini(images: list, country: str) -> dict | None:
+# Повторы ограничены и по числу, и по времени: вызов с документами ждет до 120 с,
+# и после DeadlineExceeded на нем бот уже давно не ждет ответа
+@retry(
+    wait=wait_exponential_jitter(1, 10),
+    stop=stop_after_attempt(4) | stop_after_delay(60),
+    retry=retry_if_exception_type((
+        google_exceptions.ResourceExhausted,
+        google_exceptions.InternalServerError,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    )),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+async def _generate_text(model: genai.GenerativeModel, contents, *, stream: bool = False, **kwargs) -> str:
+    """Вызывает Gemini с ограничением параллелизма и повторами при временных сбоях, возвращает текст ответа."""
+    async with GEMINI_SEMAPHORE:
+        response = await model.generate_content_async(contents, stream=stream, **kwargs)
+        if not stream:
+            return response.text
+        # chunk.text падает на чанках без текста (служебные, с finish_reason);
+        # SDK сам склеивает чанки в ответ, и после чтения потока response.text содержит весь текст
+        async for _ in response:
+            pass
+        return response.text
+
+async def recognize_documents_with_gemini(images: list, country: str) -> dict | None:
     """Распознает документы с использованием твоих оригинальных промптов."""
     try:
-        from google.generativeai.types import HarmCategory, HarmBlockThreshold
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        }
-        model = genai.GenerativeModel('gemini-2.5-flash-lite', safety_settings=safety_settings)
-
-        if country == 'РФ':
-            # ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ПАСПОРТА РФ
-            prompt = """
-            Проанализируй эти три изображения: основной разворот паспорта РФ, страница с пропиской и селфи с паспортом.
-            Извлеки все данные и верни их в виде ОДНОГО плоского JSON объекта.
-            Ключи: "Фамилия", "Имя", "Отчество", "Дата рождения", "Серия и номер паспорта", "Кем выдан", "Дата выдачи", "Адрес регистрации".
-            Если поле не найдено, значение должно быть пустой строкой.
-            Ответ должен быть только чистым JSON.
-            """
-        else:
-            # ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ИНОСТРАННЫХ ДОКУМЕНТОВ
-            prompt = """
-            Проанализируй эти четыре изображения: паспорт иностранного гражданина, регистрация в РФ, патент и селфи с паспортом.
-            Извлеки все данные и верни их в виде ОДНОГО плоского JSON объекта.
-            Ключи: "ФИО", "Гражданство", "Дата рождения", "Номер паспорта", "Адрес регистрации в РФ", "Номер патента".
-            Если поле не найдено, значение должно быть пустой строкой.
-            Ответ должен быть только чистым JSON.
-            """
-        
-        response = model.generate_content([prompt] + images, request_options={"timeout": 120})
-        response.resolve()
-        cleaned_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-        logger.info(f"Ответ от Gemini (документы): {cleaned_text}")
-        return json.loads(cleaned_text)
+        model = MODEL_FLASH_LITE_SAFE
+        prompt, generation_config, adapter = DOC_SPECS.get(country, DOC_SPEC_FOREIGN)
+        # Ответ с документами самый длинный: читаем его потоком, не дожидаясь полной генерации одним куском
+        response_text = await _generate_text(model, [prompt] + images, generation_config=generation_config, stream=True, request_options={"timeout": 120})
+        logger.debug("Ответ от Gemini (документы): %s", response_text)
+        return adapter.validate_python(orjson.loads(response_text))
 
+    except ValidationError as e:
+        logger.error("Ответ Gemini (документы) не прошел проверку: %s", e)
+        return None
     except Exception as e:
-        logger.error(f"Ошибка Gemini (документы): {e}", exc_info=True)
+        logger.error("Ошибка Gemini (документы): %s", e, exc_info=True)
         return None
 
-def parse_custom_deal_with_gemini(description: str) -> dict | None:
+async def parse_custom_deal_with_gemini(description: str) -> dict | None:
     """Распознает комплектующие из описания сделки."""
+    return await _cached_call("parse_deal", description, lambda: _request_custom_deal(description))
+
+async def _request_custom_deal(description: str) -> dict | None:
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        prompt = f"""
-        Проанализируй описание комплекта: "{description}".
-        Извлеки название/модель велосипеда, его серийный номер (VIN),
-        а также количество, емкость (Ah) и серийные номера аккумуляторов.
-        Верни результат СТРОГО в формате JSON.
-        Ключи: "model_name", "bike_number", "batteries".
-        "batteries" должен быть списком словарей, каждый с ключами "capacity" и "number".
-        Если что-то не найдено, значение должно быть null.
-        """
-        response = model.generate_content(prompt)
-        response.resolve()
-        cleaned_text = response.text.strip().replace("`", "").lstrip("json").strip()
-        logger.info(f"Ответ от Gemini (комплект): {cleaned_text}")
-        return json.loads(cleaned_text)
+        model = MODEL_FLASH_LITE
+        prompt = f"{PARSE_DEAL_PROMPT_HEAD}{description}{PARSE_DEAL_PROMPT_TAIL}"
+        response_text = await _generate_text(model, prompt, generation_config=PARSE_DEAL_CONFIG)
+        logger.debug("Ответ от Gemini (комплект): %s", response_text)
+        return CustomDeal.model_validate(orjson.loads(response_text)).model_dump()
+    except ValidationError as e:
+        logger.error("Ответ Gemini (комплект) не прошел проверку: %s", e)
+        return None
     except Exception as e:
-        logger.error(f"Ошибка Gemini (комплект): {e}", exc_info=True)
+        logger.error("Ошибка Gemini (комплект): %s", e, exc_info=True)
         return None
 
-def get_buyout_plans_with_gemini(deal_description: str) -> dict | None:
+async def get_buyout_plans_with_gemini(deal_description: str) -> dict | None:
     """Генерирует планы выкупа по описанию комплекта."""
+    vector = None
+
+    async def similar_plans() -> dict | None:
+        nonlocal vector
+        vector = await _embed(deal_description)
+        if vector is None:
+            return None
+        cached = buyout_semantic_cache.get(vector, deal_description)
+        if cached is not None:
+            logger.info("Планы выкупа взяты из кэша по похожему описанию.")
+        return cached
+
+    async def generate_plans() -> dict | None:
+        data = await _request_buyout_plans(deal_description)
+        if data is not None and vector is not None:
+            buyout_semantic_cache.set(vector, deal_description, data)
+        return data
+
+    return await _cached_call("buyout_plans", deal_description, generate_plans, approximate=similar_plans)
+
+async def _embed(text: str) -> np.ndarray | None:
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        # ТВОЙ ИДЕАЛЬНЫЙ ПРОМПТ ДЛЯ ПЛАНОВ
-        prompt = f"""
-        Проанализируй описание комплекта для курьера: "{deal_description}".
-        Это может быть электровелосипед, аккумуляторы или и то, и другое.
-        Примерная рыночная стоимость такого комплекта около 80,000 - 120,000 рублей.
-        Твоя задача - сгенерировать 3-4 варианта плана рассрочки (выкупа) для этого комплекта.
-        Верни результат СТРОГО в формате JSON. Ответ должен быть только чистым JSON объектом,
-        без лишних слов, комментариев или ```json ``` оберток.
-        Ключами в JSON должны быть короткие идентификаторы (например, "plan_1", "plan_2"),
-        а значениями - словари с ключами:
-        - "label": Короткое и понятное описание для кнопки (например, "3 мес / 16000 ₽").
-        - "full_label": Полное описание для подтверждения (например, "3 месяца: 7 платежей по 16 000 ₽").
-        - "first_payment": Сумма первого взноса (число).
-        - "total_payments": Общее количество платежей (число).
-        - "period_days": Периодичность платежей в днях (30 для месяца, 14 для 2 недель).
-        Пример твоего идеального ответа:
-        {{
-            "plan_1": {{"label": "3 мес / 16000 ₽", "full_label": "3 месяца: 7 платежей по 16 000 ₽ (раз в 2 недели)", "first_payment": 16000, "total_payments": 7, "period_days": 14}},
-            "plan_2": {{"label": "4 мес / 21000 ₽", "full_label": "4 месяца: 5 платежей по 21 000 ₽ (раз в месяц)", "first_payment": 21000, "total_payments": 5, "period_days": 30}}
-        }}
-        """
-        response = model.generate_content(prompt)
-        response.resolve()
-        cleaned_text = response.text.strip().replace("`", "").lstrip("json").strip()
-        logger.info(f"Ответ от Gemini (планы выкупа): {cleaned_text}")
-        return json.loads(cleaned_text)
+        # Эмбеддинг лишь ускоряет ответ: если сервис тормозит, быстрее сразу идти за генерацией
+        result = await genai.embed_content_async(
+            model=EMBEDDING_MODEL, content=text, task_type="SEMANTIC_SIMILARITY",
+            output_dimensionality=EMBEDDING_DIMENSIONS, request_options={"timeout": 5, "retry": None},
+        )
     except Exception as e:
-        logger.error(f"Ошибка Gemini (планы выкупа): {e}", exc_info=True)
+        logger.warning("Не удалось получить эмбеддинг описания: %s", e)
         return None
+    # Усеченный вектор gemini-embedding-001 приходит ненормированным
+    vector = np.asarray(result["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+async def _request_buyout_plans(deal_description: str) -> dict | None:
+    try:
+        model = MODEL_FLASH_LITE
+        prompt = f"{BUYOUT_PROMPT_HEAD}{deal_description}{BUYOUT_PROMPT_TAIL}"
+        response_text = await _generate_text(model, prompt, generation_config=BUYOUT_CONFIG)
+        logger.debug("Ответ от Gemini (планы выкупа): %s", response_text)
+        return BuyoutResponse.model_validate(orjson.loads(response_text)).model_dump()
+    except ValidationError as e:
+        logger.error("Ответ Gemini (планы выкупа) не прошел проверку: %s", e)
+        return None
+    except Exception as e:
+        logger.error("Ошибка Gemini (планы выкупа): %s", e, exc_info=True)
+        return None
+
+# ==============================================================================
+# ПОДГОТОВКА ИЗОБРАЖЕНИЙ
+# ==============================================================================
+
+# Gemini режет крупные изображения на плитки 768x768 (по 258 токенов каждая).
+# 1536 px = ровно две плитки по длинной стороне: при 1600 px было бы уже три,
+# а для OCR документов большее разрешение ничего не дает.
+IMAGE_MAX_SIDE = 1536
+IMAGE_JPEG_QUALITY = 85
+
+def _prepare_image(raw: bytes) -> dict:
+    """Уменьшает изображение и пережимает его в JPEG (выполняется в потоке)."""
+    if pyvips is not None:
+        img = pyvips.Image.thumbnail_buffer(raw, IMAGE_MAX_SIDE, height=IMAGE_MAX_SIDE, size="down")
+        if img.hasalpha():
+            img = img.flatten(background=[255, 255, 255])
+        data = img.write_to_buffer(f".jpg[Q={IMAGE_JPEG_QUALITY},optimize_coding,strip]")
+        return {"mime_type": "image/jpeg", "data": data}
+    img = Image.open(BytesIO(raw))
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    buf = BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+def _decode_one(b64: str) -> dict:
+    """Декодирует изображение из base64 и готовит его для Gemini (выполняется в потоке)."""
+    return _prepare_image(base64.b64decode(b64))
+
+async def _prepare_unique(items: list, worker) -> list[dict]:
+    """Параллельно обрабатывает изображения вне event loop, одинаковые файлы обрабатываются один раз.
+
+    Порядок сохраняется: модели важно, на каком месте стоит каждая страница.
+    """
+    unique = list(dict.fromkeys(items))
+    prepared = await asyncio.gather(*[asyncio.to_thread(worker, item) for item in unique])
+    by_item = dict(zip(unique, prepared))
+    return [by_item[item] for item in items]
+
+async def decode_images(images_base64: list[str]) -> list[dict]:
+    """Готовит изображения из base64 для Gemini."""
+    return await _prepare_unique(images_base64, _decode_one)
+
+async def prepare_images(raw_images: list[bytes]) -> list[dict]:
+    """Готовит загруженные файлы для Gemini."""
+    return await _prepare_unique(raw_images, _prepare_image)
 
 # ==============================================================================
 # API ЭНДПОИНТЫ
 # ==============================================================================
 
-@app.post("/recognize-documents")
+async def _check_gemini_model(model_name: str) -> None:
+    try:
+        await asyncio.to_thread(genai.get_model, model_name, request_options={"timeout": 5, "retry": None})
+    except google_exceptions.NotFound as e:
+        logger.critical("Модель Gemini %s не найдена: %s", model_name, e)
+        raise
+    # Неверный или просроченный ключ (400 InvalidArgument) и сетевые сбои не должны ронять шлюз: /notify работает без Gemini
+    except Exception as e:
+        logger.warning("Не удалось проверить модель Gemini %s: %s", model_name, e)
+
+async def check_gemini_models():
+    # Опечатка в имени модели иначе проявляется только на первом запросе пользователя.
+    # Проверки идут параллельно, с коротким таймаутом и без повторов: пока они идут, шлюз не обслуживает запросы
+    model_names = {MODEL_FLASH_LITE.model_name, MODEL_FLASH_LITE_SAFE.model_name, EMBEDDING_MODEL}
+    await asyncio.gather(*[_check_gemini_model(name) for name in model_names])
+
+async def warm_up_gemini():
+    # SDK держит один асинхронный gRPC-канал (HTTP/2) на процесс для всех моделей.
+    # Дешевый count_tokens открывает его заранее, чтобы TLS-рукопожатие не доставалось первому клиенту.
+    # Короткий таймаут без повторов: недоступный Gemini не должен задерживать старт шлюза
+    try:
+        await MODEL_FLASH_LITE.count_tokens_async("ping", request_options={"timeout": 5, "retry": None})
+        logger.info("Соединение с Gemini установлено заранее.")
+    except Exception as e:
+        logger.warning("Не удалось заранее открыть соединение с Gemini: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Через asyncio.to_thread идут обработка изображений, кэш SQLite и синхронные вызовы SDK
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=int(os.getenv("THREAD_POOL_SIZE", "32"))))
+    await check_gemini_models()
+    await warm_up_gemini()
+    # Один клиент на процесс: соединение с api.telegram.org переиспользуется между уведомлениями
+    async with httpx.AsyncClient(
+        base_url=f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}",
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+        timeout=httpx.Timeout(10.0, connect=5.0),
+    ) as telegram:
+        app.state.telegram = telegram
+        yield
+
+app = FastAPI(title="Универсальный API Шлюз для Gemini и Telegram", lifespan=lifespan)
+
+# Устаревший вариант с base64 в JSON: оставлен для старых ботов, новым клиентам нужен /recognize-documents-multipart
+@app.post("/recognize-documents", deprecated=True)
 async def api_recognize_documents(request: RecognizeDocsRequest):
-    logger.info(f"Входящий запрос /recognize-documents для страны: {request.country}")
-    images = [Image.open(BytesIO(base64.b64decode(b64))) for b64 in request.images_base64]
-    data = recognize_documents_with_gemini(images, request.country)
+    logger.info("Входящий запрос /recognize-documents для страны: %s", request.country)
+    images = await decode_images(request.images_base64)
+    data = await recognize_documents_with_gemini(images, request.country)
+    if data: return data
+    raise HTTPException(status_code=500, detail="Ошибка распознавания документов на стороне Gemini.")
+
+@app.post("/recognize-documents-multipart")
+async def api_recognize_documents_multipart(files: list[UploadFile] = File(...), country: str = Form(...)):
+    logger.info("Входящий запрос /recognize-documents-multipart для страны: %s", country)
+    images = await prepare_images([await f.read() for f in files])
+    data = await recognize_documents_with_gemini(images, country)
     if data: return data
     raise HTTPException(status_code=500, detail="Ошибка распознавания документов на стороне Gemini.")
 
+@app.post("/recognize-documents-batch")
+async def api_recognize_documents_batch(request: RecognizeDocsBatchRequest):
+    logger.info("Входящий запрос /recognize-documents-batch: %s наборов", len(request.items))
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def recognize_item(item: RecognizeDocsRequest) -> dict | None:
+        async with semaphore:
+            images = await decode_images(item.images_base64)
+            return await recognize_documents_with_gemini(images, item.country)
+
+    results = await asyncio.gather(*[recognize_item(item) for item in request.items], return_exceptions=True)
+    # Ошибка в одном наборе не должна ронять весь пакет: на его месте будет null
+    return [None if isinstance(r, Exception) else r for r in results]
+
 @app.post("/parse-deal")
 async def api_parse_deal(request: ParseDealRequest):
-    logger.info(f"Входящий запрос /parse-deal: {request.description}")
-    data = parse_custom_deal_with_gemini(request.description)
+    logger.info("Входящий запрос /parse-deal: %s", request.description)
+    data = await parse_custom_deal_with_gemini(request.description)
     if data: return data
     raise HTTPException(status_code=400, detail="Не удалось распознать описание комплекта.")
 
 @app.post("/generate-buyout-plans")
+@app.post("/get-buyout-plans")
 async def api_generate_buyout_plans(request: BuyoutPlanRequest):
-    logger.info(f"Входящий запрос /generate-buyout-plans: {request.deal_description}")
-    data = get_buyout_plans_with_gemini(request.deal_description)
+    logger.info("Входящий запрос /generate-buyout-plans: %s", request.deal_description)
+    data = await get_buyout_plans_with_gemini(request.deal_description)
     if data: return data
     raise HTTPException(status_code=400, detail="Не удалось сгенерировать планы выкупа.")
 
+# Пользователи, заблокировавшие бота (Telegram ответил 403): user_id -> до какого момента не пытаться
+BLOCKED_CHAT_TTL = 10 * 60
+BLOCKED_CHAT_MAX = 10000
+_blocked_chats: dict[int, float] = {}
+
+def _is_chat_blocked(user_id: int) -> bool:
+    expires_at = _blocked_chats.get(user_id)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        del _blocked_chats[user_id]
+        return False
+    return True
+
+def _mark_chat_blocked(user_id: int) -> None:
+    _blocked_chats.pop(user_id, None)
+    _blocked_chats[user_id] = time.monotonic() + BLOCKED_CHAT_TTL
+    if len(_blocked_chats) > BLOCKED_CHAT_MAX:
+        del _blocked_chats[next(iter(_blocked_chats))]
+
+async def send_notification(client: httpx.AsyncClient, user_id: int, text: str) -> None:
+    """Отправляет сообщение в Telegram; выполняется в фоне, ошибки только логируются."""
+    try:
+        payload = orjson.dumps({"chat_id": user_id, "text": text, "parse_mode": "Markdown"})
+        response = await client.post("/sendMessage", content=payload, headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+        logger.info("Уведомление успешно отправлено пользователю %s", user_id)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 403:
+            _mark_chat_blocked(user_id)
+        # Тело ошибки не обязательно JSON (например, HTML-страница 502 от прокси)
+        logger.error("Ошибка от Telegram API для user %s: %s %s", user_id, e.response.status_code, e.response.text)
+    except httpx.HTTPError as e:
+        logger.error("Не удалось отправить уведомление пользователю %s: %s", user_id, e)
+
 @app.post("/notify")
-async def notify_user(request: NotifyRequest, http_request: Request):
-    logger.info(f"Входящий запрос /notify для user_id: {request.user_id}")
-    if http_request.headers.get('x-internal-secret') != INTERNAL_SECRET:
-        logger.warning(f"Попытка неавторизованного доступа к /notify с IP: {http_request.client.host}")
+async def notify_user(request: NotifyRequest, http_request: Request, background_tasks: BackgroundTasks):
+    logger.info("Входящий запрос /notify для user_id: %s", request.user_id)
+    provided_secret = http_request.headers.get('x-internal-secret', '').encode()
+    if not INTERNAL_SECRET or not hmac.compare_digest(provided_secret, INTERNAL_SECRET.encode()):
+        logger.warning("Попытка неавторизованного доступа к /notify с IP: %s", http_request.client.host)
         raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    telegram_api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(telegram_api_url, json={"chat_id": request.user_id, "text": request.text, "parse_mode": "Markdown"})
-            response.raise_for_status()
-            logger.info(f"Уведомление успешно отправлено пользователю {request.user_id}")
-            return {"success": True}
-        except httpx.HTTPStatusError as e:
-            error_info = e.response.json()
-            logger.error(f"Ошибка от Telegram API для user {request.user_id}: {error_info}")
-            raise HTTPException(status_code=400, detail=f"Telegram API error: {error_info.get('description')}")
+
+    if _is_chat_blocked(request.user_id):
+        logger.info("Пользователь %s недавно заблокировал бота, уведомление пропущено", request.user_id)
+        return {"success": False, "blocked": True}
+
+    # Вызывающий не ждет Telegram: отправка идет после ответа
+    background_tasks.add_task(send_notification, http_request.app.state.telegram, request.user_id, request.text)
+    return {"success": True, "queued": True}
 
 @app.get("/")
 async def root():
     return {"status": "Универсальный API-шлюз работает"}
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop и httptools ставятся вместе с uvicorn[standard].
+    # У каждого воркера свои GEMINI_SEMAPHORE (лимит GEMINI_CONCURRENCY), кэш по смыслу,
+    # склейка запросов и список заблокировавших бота; общий между воркерами только SQLite-кэш.
+    # os.cpu_count() в контейнере показывает ядра хоста, поэтому берем доступные процессу ядра,
+    # а на хостингах с квотой CPU (Render) лучше задать UVICORN_WORKERS явно.
+    if hasattr(os, "sched_getaffinity"):
+        default_workers = len(os.sched_getaffinity(0))
+    else:
+        default_workers = os.cpu_count() or 1
+    uvicorn.run(
+        "gemini_api_server:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("UVICORN_WORKERS", str(default_workers))),
+        loop="uvloop",
+        http="httptools",
+        backlog=2048,
+    )